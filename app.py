@@ -1,13 +1,19 @@
 import streamlit as st
-import pandas as pd
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import orjson
 import json
+import re
 from pathlib import Path
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 import os
 import tempfile
-from PyPDF2 import PdfReader
 import io
-import time
+import shutil
+import subprocess
+import hashlib
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -19,8 +25,14 @@ if 'messages' not in st.session_state:
     st.session_state.messages = []
 if 'system_prompt' not in st.session_state:
     st.session_state.system_prompt = ""
+if 'base_prompt' not in st.session_state:
+    st.session_state.base_prompt = ""
 if 'assistant_id' not in st.session_state:
     st.session_state.assistant_id = None
+if 'assistant_sig' not in st.session_state:
+    st.session_state.assistant_sig = None
+if 'prompt_sig' not in st.session_state:
+    st.session_state.prompt_sig = None
 if 'thread_id' not in st.session_state:
     st.session_state.thread_id = None
 if 'client' not in st.session_state:
@@ -28,99 +40,254 @@ if 'client' not in st.session_state:
 if 'selected_model' not in st.session_state:
     st.session_state.selected_model = 'gpt-4o'
 
+@st.cache_resource
+def get_client(api_key):
+    """Get an OpenAI client shared across sessions, so connections are reused"""
+    return OpenAI(api_key=api_key, http_client=DefaultHttpxClient(http2=True))
+
 # Initialize OpenAI client with API key from environment variable
 if not st.session_state.client:
     api_key = os.environ.get('OPENAI_API_KEY')
     if api_key:
-        st.session_state.client = OpenAI()
+        st.session_state.client = get_client(api_key)
+
+# Use poppler's pdftotext for PDF extraction when it is installed
+PDFTOTEXT = shutil.which("pdftotext")
+
+# Seconds to wait for pdftotext before falling back to PyMuPDF
+PDFTOTEXT_TIMEOUT = 60
+
+# Maximum number of rows and columns included from CSV and Excel files
+MAX_ROWS = 1000
+MAX_COLS = 40
+
+# Maximum number of pages read from PDF files
+MAX_PDF_PAGES = int(os.getenv("MAX_PDF_PAGES", "50"))
+
+# orjson turns integers wider than 64 bits into floats, so JSON with 20+ digit
+# numbers goes through the json module instead
+LONG_INTEGER_RE = re.compile(rb"\d{20}")
+
+# PyMuPDF does not support multithreading, so all use of it is serialized
+FITZ_LOCK = threading.Lock()
+
+def read_pdf_with_pdftotext(data):
+    """Read content from PDF bytes using the pdftotext binary"""
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+        tmp.write(data)
+        tmp.flush()
+        result = subprocess.run(
+            [PDFTOTEXT, "-layout", "-l", str(MAX_PDF_PAGES), tmp.name, "-"],
+            capture_output=True,
+            check=True,
+            timeout=PDFTOTEXT_TIMEOUT
+        )
+    return result.stdout.decode("utf-8", errors="replace")
+
+def read_pdf_page_count(data):
+    """Count the pages of a PDF, or None if PyMuPDF cannot open it"""
+    import fitz
+
+    try:
+        with FITZ_LOCK, fitz.open(stream=data, filetype="pdf") as doc:
+            return doc.page_count
+    except Exception:
+        return None
+
+def read_pdf_content(data):
+    """Read content from PDF bytes, up to MAX_PDF_PAGES pages"""
+    import fitz
+
+    text = None
+    page_count = None
+    if PDFTOTEXT:
+        try:
+            text = read_pdf_with_pdftotext(data)
+        except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            # Fall back to PyMuPDF below
+            pass
+        else:
+            page_count = read_pdf_page_count(data)
+
+    if text is None:
+        try:
+            with FITZ_LOCK, fitz.open(stream=data, filetype="pdf") as doc:
+                page_count = doc.page_count
+                pages = doc.pages(0, min(page_count, MAX_PDF_PAGES))
+                text = "\n".join(page.get_text("text") for page in pages)
+        except Exception as e:
+            return f"Error reading PDF: {str(e)}"
+
+    if page_count is not None and page_count > MAX_PDF_PAGES:
+        text += f"\n[truncated at {MAX_PDF_PAGES} pages]"
+    return text
+
+def read_text_content(data):
+    """Read content from plain text bytes"""
+    return data.decode('utf-8')
+
+def format_table_content(df):
+    """Serialize a table as CSV, noting when rows or columns were cut off"""
+    limits = []
+    if len(df) > MAX_ROWS:
+        limits.append(f"{MAX_ROWS} rows")
+    if len(df.columns) > MAX_COLS:
+        limits.append(f"{MAX_COLS} columns")
+
+    content = df.iloc[:MAX_ROWS, :MAX_COLS].to_csv(index=False)
+    if limits:
+        content += f"[truncated at {' and '.join(limits)}]"
+    return content
+
+def read_csv_content(data):
+    """Read content from CSV bytes"""
+    import pandas as pd
+
+    df = pd.read_csv(io.BytesIO(data), nrows=MAX_ROWS + 1)
+    return format_table_content(df)
+
+def read_json_content(data):
+    """Read content from JSON bytes"""
+    if not LONG_INTEGER_RE.search(data):
+        try:
+            content = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN, Infinity and a UTF-8 BOM, which json accepts
+            pass
+        else:
+            return orjson.dumps(content, option=orjson.OPT_INDENT_2).decode('utf-8')
+
+    content = json.loads(data)
+    return json.dumps(content, indent=2, ensure_ascii=False)
+
+def read_excel_content(data):
+    """Read content from Excel bytes, preferring the calamine engine"""
+    import pandas as pd
 
-def read_pdf_content(file):
-    """Read content from PDF file"""
     try:
-        pdf_reader = PdfReader(io.BytesIO(file.getvalue()))
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text
+        df = pd.read_excel(io.BytesIO(data), nrows=MAX_ROWS + 1, engine="calamine")
+    except (ImportError, ValueError):
+        # calamine not installed or not supported by this pandas version
+        df = pd.read_excel(io.BytesIO(data), nrows=MAX_ROWS + 1)
+    return format_table_content(df)
+
+# Content readers by file extension
+FILE_HANDLERS = {
+    '.pdf': read_pdf_content,
+    '.txt': read_text_content,
+    '.csv': read_csv_content,
+    '.json': read_json_content,
+    '.xlsx': read_excel_content,
+    '.xls': read_excel_content,
+}
+
+@st.cache_data(show_spinner=False, max_entries=100)
+def parse_file_bytes(name, data):
+    """Parse file bytes based on file type, cached on name and content"""
+    handler = FILE_HANDLERS.get(Path(name).suffix.lower())
+    if handler is None:
+        return "Unsupported file type"
+    
+    try:
+        return handler(data)
     except Exception as e:
-        return f"Error reading PDF: {str(e)}"
+        return f"Error reading file: {str(e)}"
 
 def read_file_content(uploaded_file):
     """Read content from uploaded file based on file type"""
     if uploaded_file is None:
         return ""
     
-    file_extension = Path(uploaded_file.name).suffix.lower()
-    
+    return parse_file_bytes(uploaded_file.name, uploaded_file.getvalue())
+
+def assistant_signature(model, instructions):
+    """Identify an assistant configuration by model and instructions hash"""
+    instructions_hash = hashlib.blake2b(instructions.encode(), digest_size=16).hexdigest()
+    return (model, instructions_hash)
+
+def initialize_assistant(client, instructions):
+    """Initialize or update the OpenAI assistant"""
+    model = st.session_state.selected_model
+    sig = assistant_signature(model, instructions)
+    assistant_id = st.session_state.assistant_id
+    previous_sig = st.session_state.assistant_sig
+
     try:
-        if file_extension == '.pdf':
-            content = read_pdf_content(uploaded_file)
-        elif file_extension == '.txt':
-            content = uploaded_file.getvalue().decode('utf-8')
-        elif file_extension == '.csv':
-            df = pd.read_csv(uploaded_file)
-            content = df.to_string()
-        elif file_extension == '.json':
-            content = json.load(uploaded_file)
-            content = json.dumps(content, indent=2)
-        elif file_extension in ['.xlsx', '.xls']:
-            df = pd.read_excel(uploaded_file)
-            content = df.to_string()
+        if assistant_id and previous_sig == sig:
+            # Nothing changed, reuse the existing assistant
+            return assistant_id
+
+        if assistant_id and previous_sig and previous_sig[0] == model:
+            # Only the instructions changed, update in place
+            client.beta.assistants.update(assistant_id, instructions=instructions)
         else:
-            content = "Unsupported file type"
-        return content
+            # Create a new assistant
+            assistant = client.beta.assistants.create(
+                name="File Analysis Assistant",
+                instructions=instructions,
+                tools=[{"type": "code_interpreter"}],
+                model=model
+            )
+            assistant_id = assistant.id
+
+        st.session_state.assistant_sig = sig
+        return assistant_id
     except Exception as e:
-        return f"Error reading file: {str(e)}"
+        st.error(f"Error creating assistant: {str(e)}")
+        return None
 
-def initialize_assistant(client, instructions):
-    """Initialize or update the OpenAI assistant"""
+async def create_assistant_and_thread(api_key, instructions, model):
+    """Create a new assistant and thread concurrently"""
+    async with AsyncOpenAI(
+        api_key=api_key, http_client=DefaultAsyncHttpxClient(http2=True)
+    ) as async_client:
+        assistant, thread = await asyncio.gather(
+            async_client.beta.assistants.create(
+                name="File Analysis Assistant",
+                instructions=instructions,
+                tools=[{"type": "code_interpreter"}],
+                model=model
+            ),
+            async_client.beta.threads.create()
+        )
+    return assistant.id, thread.id
+
+def reinitialize_assistant(client, instructions, model):
+    """Create a new assistant and thread for the given model"""
     try:
-        # Create a new assistant
-        assistant = client.beta.assistants.create(
-            name="File Analysis Assistant",
-            instructions=instructions,
-            tools=[{"type": "code_interpreter"}],
-            model=st.session_state.selected_model
+        assistant_id, thread_id = asyncio.run(
+            create_assistant_and_thread(client.api_key, instructions, model)
         )
-        return assistant.id
     except Exception as e:
         st.error(f"Error creating assistant: {str(e)}")
-        return None
+        return None, None
+
+    st.session_state.assistant_sig = assistant_signature(model, instructions)
+    return assistant_id, thread_id
 
 def get_ai_response(client, thread_id, prompt):
-    """Get response using the Assistants API"""
+    """Stream the response text using the Assistants API"""
     try:
         # Add the message to the thread
-        message = client.beta.threads.messages.create(
+        client.beta.threads.messages.create(
             thread_id=thread_id,
             role="user",
             content=prompt
         )
 
-        # Run the assistant
-        run = client.beta.threads.runs.create(
+        # Run the assistant and yield the text as it arrives
+        with client.beta.threads.runs.stream(
             thread_id=thread_id,
             assistant_id=st.session_state.assistant_id
-        )
-
-        # Wait for the run to complete
-        while True:
-            run_status = client.beta.threads.runs.retrieve(
-                thread_id=thread_id,
-                run_id=run.id
-            )
-            if run_status.status == 'completed':
-                break
-            elif run_status.status == 'failed':
-                return "Error: Assistant run failed"
-            time.sleep(1)
+        ) as stream:
+            yield from stream.text_deltas
+            run = stream.get_final_run()
 
-        # Get the latest message from the thread
-        messages = client.beta.threads.messages.list(thread_id=thread_id)
-        return messages.data[0].content[0].text.value
+        if run.status != 'completed':
+            yield f"\n\nError: Assistant run {run.status}"
 
     except Exception as e:
-        return f"Error: {str(e)}"
+        yield f"Error: {str(e)}"
 
 # Sidebar for configuration
 with st.sidebar:
@@ -139,22 +306,27 @@ with st.sidebar:
     
     # Update model if changed
     if selected_model != st.session_state.selected_model:
-        st.session_state.selected_model = selected_model
-        if st.session_state.client:
-            # Reinitialize assistant with new model
-            assistant_id = initialize_assistant(st.session_state.client, st.session_state.system_prompt)
+        if not st.session_state.client:
+            st.session_state.selected_model = selected_model
+        else:
+            # Reinitialize assistant with new model and start a fresh thread.
+            # The model is only switched on success, so a failed switch is retried.
+            assistant_id, thread_id = reinitialize_assistant(
+                st.session_state.client, st.session_state.system_prompt, selected_model
+            )
             if assistant_id:
+                st.session_state.selected_model = selected_model
                 st.session_state.assistant_id = assistant_id
-                thread = st.session_state.client.beta.threads.create()
-                st.session_state.thread_id = thread.id
+                st.session_state.thread_id = thread_id
                 st.session_state.messages = []
                 st.rerun()
     
     # System prompt input
     st.subheader("System Prompt")
+    # Keyed on the base prompt alone, so the combined prompt never feeds back into it
     system_prompt_input = st.text_area(
         "Enter base system prompt",
-        value=st.session_state.system_prompt,
+        key="base_prompt",
         height=150
     )
     
@@ -169,12 +341,31 @@ with st.sidebar:
     # Read and combine file contents
     file_contents = ""
     if uploaded_files:
-        for file in uploaded_files:
-            content = read_file_content(file)
-            file_contents += f"\n### Content from {file.name}:\n{content}\n"
+        # Parse non-PDF files concurrently, keeping the upload order in the result.
+        # Workers get the script run context so the cached parser can run there.
+        with ThreadPoolExecutor(
+            max_workers=min(8, len(uploaded_files)),
+            initializer=add_script_run_ctx,
+            initargs=(None, get_script_run_ctx())
+        ) as executor:
+            futures = [
+                None if Path(file.name).suffix.lower() == '.pdf'
+                else executor.submit(read_file_content, file)
+                for file in uploaded_files
+            ]
+            # PyMuPDF is not thread-safe and holds the GIL, so PDFs are parsed here
+            contents = [
+                read_file_content(file) if future is None else future.result()
+                for file, future in zip(uploaded_files, futures)
+            ]
+        file_contents = "".join(
+            f"\n### Content from {file.name}:\n{content}\n"
+            for file, content in zip(uploaded_files, contents)
+        )
 
-    # Update system prompt
-    if system_prompt_input or file_contents:
+    # Update system prompt, skipping reruns where neither the prompt nor the files changed
+    prompt_sig = hash((system_prompt_input, file_contents))
+    if (system_prompt_input or file_contents) and prompt_sig != st.session_state.prompt_sig:
         st.session_state.system_prompt = f"{system_prompt_input}\n\nContext from uploaded files:\n\n{file_contents}"
         
         # Initialize or update assistant if we have a client
@@ -183,6 +374,7 @@ with st.sidebar:
             assistant_id = initialize_assistant(st.session_state.client, st.session_state.system_prompt)
             if assistant_id:
                 st.session_state.assistant_id = assistant_id
+                st.session_state.prompt_sig = prompt_sig
                 # Create a new thread if we don't have one
                 if not st.session_state.thread_id:
                     thread = st.session_state.client.beta.threads.create()
@@ -217,14 +409,12 @@ if prompt := st.chat_input("Enter your message"):
     
     # Get and display assistant response
     with st.chat_message("assistant"):
-        with st.spinner("Thinking..."):
-            response = get_ai_response(
-                st.session_state.client,
-                st.session_state.thread_id,
-                prompt
-            )
-            st.write(response)
-            st.session_state.messages.append({"role": "assistant", "content": response})
+        response = st.write_stream(get_ai_response(
+            st.session_state.client,
+            st.session_state.thread_id,
+            prompt
+        ))
+        st.session_state.messages.append({"role": "assistant", "content": response})
 
 # Clear chat button
 if st.button("Clear Chat"):